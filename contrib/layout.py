@@ -8,13 +8,28 @@
 #
 # Q: Wow, this looks complicated!
 # A: For simple layouts, you really only need to care about what's in the
-#    layout_handle_layout_demand() function. And the rest isn't as complicated
-#    as it looks.
+#    _compute_spiral() function, which returns the position and size of every
+#    view. And the rest isn't as complicated as it looks. Its results are
+#    cached, so it must stay a pure function of its arguments: the same view
+#    count and usable area always have to give the same rectangles.
 #
 # Q: The script runs but nothing happens! How can I see this layout?
 # A: Once started, to set this layout as default use the command:
 #    riverctl default-layout layout.py
+#
+# Q: Can I avoid going through pywayland for every pushed view?
+# A: Not from python. Every view dimension is a separate protocol request
+#    marshalled by pywayland. If that overhead matters to you, write the
+#    layout generator against libwayland-client directly. See layout.c in
+#    this directory for a complete example.
+#
+# Q: My layout does a lot more math than this one. Can I speed it up?
+# A: Try running the script with PyPy (pypy3 layout.py). Its JIT compiles hot
+#    integer loops like the one in _compute_spiral() to native code, and
+#    pywayland is built on cffi, which PyPy supports.
 
+import functools
+import math
 import mmap
 import time
 from pywayland.client import Display
@@ -32,31 +47,80 @@ except:
     print(river_layout_help)
     quit()
 
-layout_manager = None
-outputs = []
-loop = True
-
-def layout_handle_layout_demand(layout, view_count, usable_w, usable_h, tags, serial):
+# Every view of the spiral halves the remaining area, alternating between
+# splitting it vertically and horizontally. The position of the new view
+# inside the area it was split from repeats every four views: left, top,
+# right, bottom. For each step of that cycle, this table holds by how many
+# widths/heights the pushed view is offset, followed by how many widths/heights
+# the remaining area moves.
+SPIRAL_STEPS = (
+    (0, 0, 1, 0),
+    (0, 0, 0, 1),
+    (1, 0, 0, 0),
+    (0, 1, 0, 0),
+)
+
+# Each view of the spiral halves one side of the remaining area, so with many
+# views the rectangles quickly become too small to be useful. The spiral stops
+# before a view would be smaller than 2^MIN_DIM_BITS pixels on its shorter
+# side, and all remaining views share the last area in a grid.
+MIN_DIM_BITS = 6
+
+def _compute_grid(rects, view_count, x, y, w, h):
+    cols = math.isqrt(view_count)
+    if cols * cols < view_count:
+        cols += 1
+    rows = (view_count + cols - 1) // cols
+    row_h, row_rem = divmod(h, rows)
+    row_y = y
+    for row in range(rows):
+        height = row_h + row_rem if row == 0 else row_h
+        cells = min(cols, view_count - row * cols)
+        cell_w, cell_rem = divmod(w, cells)
+        cell_x = x
+        for cell in range(cells):
+            width = cell_w + cell_rem if cell == 0 else cell_w
+            rects.append((cell_x, row_y, width, height))
+            cell_x += width
+        row_y += height
+
+# The spiral only depends on the number of views and the usable area, so the
+# rectangles are computed once per geometry and replayed from the cache when
+# river asks for the same layout again, for example after a focus change.
+@functools.lru_cache(maxsize=128)
+def _compute_spiral(view_count, usable_w, usable_h):
+    rects = []
     x = 0
     y = 0
     w = usable_w
     h = usable_h
+    min_dim = 1 << MIN_DIM_BITS
     for i in range(0, view_count - 1):
-        if i % 2 == 0:
-            w //= 2
-            if i % 4 == 2:
-                layout.push_view_dimensions(x + w, y, w, h, serial)
-            else:
-                layout.push_view_dimensions(x, y, w, h, serial)
-                x += w
-        else:
-            h //= 2
-            if i % 4 == 3:
-                layout.push_view_dimensions(x, y + h, w, h, serial)
-            else:
-                layout.push_view_dimensions(x, y, w, h, serial)
-                y += h
-    layout.push_view_dimensions(x, y, w, h, serial)
+        # Before view i, the width has been halved i // 2 times and the height
+        # (i + 1) // 2 times. View i then halves the width if i is even and
+        # the height otherwise.
+        view_w = usable_w >> ((i + 2) // 2)
+        view_h = usable_h >> ((i + 1) // 2)
+        if min(view_w, view_h) < min_dim:
+            break
+        w = view_w
+        h = view_h
+        view_dx, view_dy, area_dx, area_dy = SPIRAL_STEPS[i & 3]
+        rects.append((x + view_dx * w, y + view_dy * h, w, h))
+        x += area_dx * w
+        y += area_dy * h
+    _compute_grid(rects, view_count - len(rects), x, y, w, h)
+    return tuple(rects)
+
+# Unlike the other event handlers, this is not a LayoutClient method, because it
+# does not need any client state, only the layout object and event arguments.
+def layout_handle_layout_demand(layout, view_count, usable_w, usable_h, tags, serial):
+    # tags is deliberately not passed: the spiral does not depend on it, and
+    # anything _compute_spiral() depends on has to be part of its cache key.
+    rects = _compute_spiral(view_count, usable_w, usable_h)
+    push = layout.push_view_dimensions
+    for (x, y, w, h) in rects:
+        push(x, y, w, h, serial)
 
     # Committing the layout means telling the server that your code is done
     # laying out windows. Make sure you have pushed exactly the right amount of
@@ -68,19 +132,9 @@ def layout_handle_layout_demand(layout, view_count, usable_w, usable_h, tags, se
     # information status information about your layout, which is what we do here.
     layout.commit(f"{view_count} windows laid out by python", serial)
 
-def layout_handle_namespace_in_use(layout):
-    # Oh no, the namespace we choose is already used by another client! All we
-    # can do now is destroy the layout object. Because we are lazy, we just
-    # abort and let our cleanup mechanism destroy it. A more sophisticated
-    # client could instead destroy only the one single affected layout object
-    # and recover from this mishap. Writing such a client is left as an exercise
-    # for the reader.
-    print("Namespace already in use!")
-    global loop
-    loop = False
-
 class Output(object):
-    def __init__(self):
+    def __init__(self, client):
+        self.client = client
         self.output = None
         self.layout = None
         self.id = None
@@ -92,55 +146,73 @@ class Output(object):
             self.output.destroy()
 
     def configure(self):
-        global layout_manager
+        layout_manager = self.client.layout_manager
         if self.layout is None and layout_manager is not None:
             # We need to set a namespace, which is used to identify our layout.
             self.layout = layout_manager.get_layout(self.output, "layout.py")
             self.layout.user_data = self
             self.layout.dispatcher["layout_demand"] = layout_handle_layout_demand
-            self.layout.dispatcher["namespace_in_use"] = layout_handle_namespace_in_use
-
-def registry_handle_global(registry, id, interface, version):
-    global layout_manager
-    global output
-    if interface == 'river_layout_manager_v3':
-        layout_manager = registry.bind(id, RiverLayoutManagerV3, version)
-    elif interface == 'wl_output':
-        output = Output()
-        output.output = registry.bind(id, WlOutput, version)
-        output.id = id
-        output.configure()
-        outputs.append(output)
-
-def registry_handle_global_remove(registry, id):
-    for output in outputs:
-        if output.id == id:
+            self.layout.dispatcher["namespace_in_use"] = self.client.handle_namespace_in_use
+
+# All state of the client lives here instead of in module level globals, which
+# keeps the event handlers free of global lookups.
+class LayoutClient(object):
+    def __init__(self):
+        self.layout_manager = None
+        self.outputs = {}
+        self.loop = True
+
+    def handle_namespace_in_use(self, layout):
+        # Oh no, the namespace we choose is already used by another client!
+        # All we can do now is destroy the layout object. Because we are lazy,
+        # we just abort and let our cleanup mechanism destroy it. A more
+        # sophisticated client could instead destroy only the one single
+        # affected layout object and recover from this mishap. Writing such a
+        # client is left as an exercise for the reader.
+        print("Namespace already in use!")
+        self.loop = False
+
+    def handle_global(self, registry, id, interface, version):
+        if interface == 'river_layout_manager_v3':
+            self.layout_manager = registry.bind(id, RiverLayoutManagerV3, version)
+        elif interface == 'wl_output':
+            output = Output(self)
+            output.output = registry.bind(id, WlOutput, version)
+            output.id = id
+            output.configure()
+            self.outputs[id] = output
+
+    def handle_global_remove(self, registry, id):
+        output = self.outputs.pop(id, None)
+        if output is not None:
             output.destroy()
-            outputs.remove(output)
 
-display = Display()
-display.connect()
+    def run(self, display):
+        registry = display.get_registry()
+        registry.dispatcher["global"] = self.handle_global
+        registry.dispatcher["global_remove"] = self.handle_global_remove
 
-registry = display.get_registry()
-registry.dispatcher["global"] = registry_handle_global
-registry.dispatcher["global_remove"] = registry_handle_global_remove
+        display.dispatch(block=True)
+        display.roundtrip()
 
-display.dispatch(block=True)
-display.roundtrip()
+        if self.layout_manager is None:
+            print("No layout_manager, aborting")
+            quit()
 
-if layout_manager is None:
-    print("No layout_manager, aborting")
-    quit()
+        for output in self.outputs.values():
+            output.configure()
 
-for output in outputs:
-    output.configure()
+        while self.loop and display.dispatch(block=True) != -1:
+            pass
 
-while loop and display.dispatch(block=True) != -1:
-    pass
+        # Destroy outputs
+        for output in self.outputs.values():
+            output.destroy()
+        self.outputs.clear()
+
+display = Display()
+display.connect()
 
-# Destroy outputs
-for output in outputs:
-    output.destroy()
-    outputs.remove(output)
+LayoutClient().run(display)
 
 display.disconnect()